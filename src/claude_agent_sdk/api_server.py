@@ -4,18 +4,228 @@ Exposes ClaudeSDKClient functionality via REST API endpoints
 """
 
 import asyncio
-import uuid
-from typing import Optional, Dict, Any, List
-from contextlib import asynccontextmanager
+import dataclasses
+import functools
+import json
+import logging
+import os
+import secrets
+import time
+from typing import (
+    Optional, Dict, Any, List, AsyncGenerator, AsyncIterable, AsyncIterator, Awaitable, Callable
+)
+from contextlib import aclosing, asynccontextmanager
 
-from fastapi import FastAPI, HTTPException, BackgroundTasks
-from fastapi.responses import StreamingResponse, JSONResponse
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.responses import StreamingResponse, JSONResponse, Response
 from pydantic import BaseModel, Field
-import uvicorn
+from starlette.types import Receive, Scope, Send
 
-from claude_agent_sdk import ClaudeSDKClient, ClaudeAgentOptions, create_sdk_mcp_server, tool
+from claude_agent_sdk import ClaudeSDKClient, ClaudeAgentOptions, ResultMessage
 from claude_agent_sdk.query import query as sdk_query
 
+try:
+    import orjson
+    _HAS_ORJSON = True
+except ImportError:  # pragma: no cover - orjson is an optional speedup
+    _HAS_ORJSON = False
+
+logger = logging.getLogger(__name__)
+
+
+# ============================================
+# Serialization Helpers
+# ============================================
+
+def _encode_message(obj: Any) -> Any:
+    """JSON encoder for SDK messages and content blocks, tagged with their class"""
+    if dataclasses.is_dataclass(obj) and not isinstance(obj, type):
+        encoded: Dict[str, Any] = {"type": type(obj).__name__}
+        for field in dataclasses.fields(obj):
+            encoded[field.name] = getattr(obj, field.name)
+        return encoded
+    if isinstance(obj, bytes):
+        return obj.decode("utf-8", "replace")
+    return str(obj)
+
+
+def _dumps(obj: Any, sort_keys: bool = False) -> bytes:
+    """Serialize an object to compact JSON bytes, preferring orjson"""
+    if _HAS_ORJSON:
+        # Route dataclasses through _encode_message so they get a type tag
+        option = orjson.OPT_PASSTHROUGH_DATACLASS
+        if sort_keys:
+            option |= orjson.OPT_SORT_KEYS
+        return orjson.dumps(obj, default=_encode_message, option=option)
+    return json.dumps(
+        obj,
+        separators=(",", ":"),
+        ensure_ascii=False,
+        sort_keys=sort_keys,
+        default=_encode_message,
+    ).encode("utf-8")
+
+
+class _FastJSONResponse(JSONResponse):
+    """JSON response rendered with _dumps (orjson when available)"""
+
+    def render(self, content: Any) -> bytes:
+        return _dumps(content)
+
+
+class _ClosingStreamingResponse(StreamingResponse):
+    """
+    StreamingResponse that always closes its body iterator once sending ends.
+    Starlette abandons the body on client disconnect; closing it here tears
+    down read-ahead producers and SDK iterators right away instead of at GC.
+    The optional cleanup runs after the body is closed, disconnect or not.
+    """
+
+    def __init__(
+        self,
+        content: Any,
+        *args: Any,
+        cleanup: Optional[Callable[[], Awaitable[None]]] = None,
+        **kwargs: Any
+    ) -> None:
+        super().__init__(content, *args, **kwargs)
+        self._cleanup = cleanup
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            try:
+                await _aclose(self.body_iterator)
+            finally:
+                if self._cleanup is not None:
+                    await self._cleanup()
+
+
+# Terminal frames are constant, so they are encoded once up front
+_SSE_DONE = b'data: {"type":"done"}\n\n'
+_SSE_ERROR_TMPL = b'data: {"type":"error","error":%s}\n\n'
+_NDJSON_DONE = b'{"type":"done"}\n'
+_NDJSON_ERROR_TMPL = b'{"type":"error","error":%s}\n'
+_SSE_MESSAGE_TMPL = b'data: {"type":"message","message":%s}\n\n'
+_NDJSON_MESSAGE_TMPL = b'{"type":"message","message":%s}\n'
+
+
+def _message_payload(message: Any) -> bytes:
+    """JSON-encode a message payload, decoding raw byte chunks as UTF-8"""
+    if isinstance(message, bytes):
+        message = message.decode("utf-8", "replace")
+    return _dumps(message)
+
+
+def _sse_message(message: Any) -> bytes:
+    """Encode a message event as an SSE frame without building an event dict"""
+    return _SSE_MESSAGE_TMPL % _message_payload(message)
+
+
+def _ndjson_message(message: Any) -> bytes:
+    """Encode a message event as an NDJSON line without building an event dict"""
+    return _NDJSON_MESSAGE_TMPL % _message_payload(message)
+
+
+def _prefers_wait(request: Request) -> bool:
+    """Whether the client explicitly asked for one buffered JSON body"""
+    accept = request.headers.get("accept", "")
+    prefer = request.headers.get("prefer", "")
+    return "application/json" in accept and "wait" in prefer
+
+
+async def _collect_or_stream(
+    messages: AsyncIterator[Any],
+    force_buffer: bool,
+    cleanup: Optional[Callable[[], Awaitable[None]]] = None,
+    **fields: Any
+) -> Response:
+    """
+    Build a non-SSE response for a message iterator.
+    Streams one NDJSON event per message unless buffering is forced, in
+    which case all messages are collected into a single JSON body.
+    The cleanup runs once the messages are no longer being read.
+    """
+    if force_buffer:
+        try:
+            collected = [message async for message in messages]
+        finally:
+            await _aclose(messages)
+            if cleanup is not None:
+                await cleanup()
+        return _FastJSONResponse({"status": "success", **fields, "messages": collected})
+    
+    async def generate() -> AsyncIterator[bytes]:
+        try:
+            async with aclosing(_read_ahead(messages)) as stream:
+                async for message in stream:
+                    yield _ndjson_message(message)
+                    # Give other streams a turn before pulling the next message
+                    await asyncio.sleep(0)
+            yield _NDJSON_DONE
+        except Exception as e:
+            logger.exception("Error while streaming NDJSON response")
+            yield _NDJSON_ERROR_TMPL % _dumps(str(e))
+    
+    return _ClosingStreamingResponse(
+        generate(), media_type="application/x-ndjson", cleanup=cleanup
+    )
+
+
+# Marks the end of a read-ahead queue
+_QUEUE_DONE = object()
+
+# Messages buffered ahead of a slow client before the SDK side waits
+_READ_AHEAD_SIZE = 16
+
+
+async def _aclose(messages: AsyncIterable[Any]) -> None:
+    """Close an async iterator if it supports it"""
+    aclose = getattr(messages, "aclose", None)
+    if aclose is not None:
+        await aclose()
+
+
+async def _read_ahead(
+    messages: AsyncIterator[Any], maxsize: int = _READ_AHEAD_SIZE
+) -> AsyncGenerator[Any, None]:
+    """
+    Iterate messages through a bounded queue filled by a background task.
+    The SDK keeps producing up to maxsize messages while the socket drains;
+    a failure in the producer is re-raised once the queued messages are out.
+    """
+    queue: asyncio.Queue[Any] = asyncio.Queue(maxsize)
+    
+    async def pump() -> None:
+        # The source is closed here, in the task that iterated it: SDK
+        # iterators hold anyio cancel scopes that must exit in that task
+        try:
+            async for message in messages:
+                await queue.put(message)
+        except asyncio.CancelledError:
+            # The consumer is gone, so nobody is left to read the end marker
+            await _aclose(messages)
+            raise
+        except Exception:
+            await _aclose(messages)
+            await queue.put(_QUEUE_DONE)
+            raise
+        await _aclose(messages)
+        await queue.put(_QUEUE_DONE)
+    
+    producer = asyncio.create_task(pump())
+    try:
+        while True:
+            message = await queue.get()
+            if message is _QUEUE_DONE:
+                break
+            yield message
+        await producer
+    finally:
+        producer.cancel()
+        await asyncio.gather(producer, return_exceptions=True)
+
 
 # ============================================
 # Pydantic Models for API Request/Response
@@ -39,6 +249,11 @@ class SessionQueryRequest(BaseModel):
     stream: bool = Field(default=True, description="Whether to stream the response")
 
 
+class CapacityUpdateRequest(BaseModel):
+    """Request model for resizing the session cap"""
+    max_sessions: int = Field(..., ge=1, description="Maximum number of concurrent sessions")
+
+
 class ToolDefinition(BaseModel):
     """Tool definition for custom tools"""
     name: str = Field(..., description="Tool name")
@@ -58,55 +273,267 @@ class ErrorResponse(BaseModel):
     detail: Optional[str] = None
 
 
+# ============================================
+# Options Construction
+# ============================================
+
+@functools.lru_cache(maxsize=256)
+def _cached_options(key: bytes) -> ClaudeAgentOptions:
+    """Build options from a canonical JSON key; cached per distinct profile"""
+    return ClaudeAgentOptions(**json.loads(key))
+
+
+def _build_options(raw: Optional[Dict[str, Any]]) -> Optional[ClaudeAgentOptions]:
+    """Convert a request options dict to ClaudeAgentOptions, reusing earlier builds"""
+    if not raw:
+        return None
+    return _cached_options(_dumps(raw, sort_keys=True))
+
+
 # ============================================
 # Session Management
 # ============================================
 
+def _options_key(options: ClaudeAgentOptions) -> str:
+    """Canonical string key identifying an options configuration"""
+    values = {
+        field.name: getattr(options, field.name)
+        for field in dataclasses.fields(options)
+    }
+    return json.dumps(values, sort_keys=True, default=repr)
+
+
+class _SessionEntry:
+    """Client, options and bookkeeping for a single active session"""
+
+    __slots__ = ("client", "options", "options_key", "created_at", "lock", "queried")
+
+    def __init__(
+        self, client: ClaudeSDKClient, options: ClaudeAgentOptions, options_key: str
+    ):
+        self.client = client
+        self.options = options
+        self.options_key = options_key
+        self.created_at = time.time()
+        self.lock = asyncio.Lock()
+        self.queried = False
+
+
+class _ClientPool:
+    """
+    Connected clients kept warm for reuse by new sessions.
+    Only clients that never received a query are pooled, since the CLI
+    keeps conversation state that cannot be reset in place.
+    """
+
+    def __init__(self, max_idle: int = 8) -> None:
+        self.max_idle = max_idle
+        self._by_options_key: Dict[str, List[ClaudeSDKClient]] = {}
+        self._idle = 0
+
+    def acquire(self, key: str) -> Optional[ClaudeSDKClient]:
+        """Pop an idle client created with matching options, if any"""
+        clients = self._by_options_key.get(key)
+        if not clients:
+            return None
+        client = clients.pop()
+        if not clients:
+            del self._by_options_key[key]
+        self._idle -= 1
+        return client
+
+    def release(self, key: str, client: ClaudeSDKClient) -> bool:
+        """Return a client to the pool; False if the pool is full"""
+        if self._idle >= self.max_idle:
+            return False
+        self._by_options_key.setdefault(key, []).append(client)
+        self._idle += 1
+        return True
+
+    async def drain(self) -> None:
+        """Disconnect all idle clients"""
+        clients = [c for idle in self._by_options_key.values() for c in idle]
+        self._by_options_key.clear()
+        self._idle = 0
+        results = await asyncio.gather(
+            *(client.__aexit__(None, None, None) for client in clients),
+            return_exceptions=True
+        )
+        for result in results:
+            if isinstance(result, BaseException):
+                logger.warning("Failed to close pooled client: %r", result)
+
+
+class SessionCapacityError(Exception):
+    """Raised when no session slot frees up within the admission timeout"""
+
+
 class SessionManager:
     """Manages active Claude SDK client sessions"""
     
-    def __init__(self):
-        self.sessions: Dict[str, ClaudeSDKClient] = {}
-        self.session_options: Dict[str, ClaudeAgentOptions] = {}
+    def __init__(self) -> None:
+        self._entries: Dict[str, _SessionEntry] = {}
+        self._pool = _ClientPool()
+        self._cap = int(os.environ.get("CLAUDE_MAX_SESSIONS", 64))
+        self._admit_timeout = float(os.environ.get("CLAUDE_SESSION_ADMIT_TIMEOUT", 30))
+        self._active = 0
+        self._cond = asyncio.Condition()
+    
+    @property
+    def capacity(self) -> int:
+        """Maximum number of concurrently active sessions"""
+        return self._cap
+    
+    async def set_capacity(self, capacity: int) -> None:
+        """Resize the session cap and wake waiters so they re-check it"""
+        async with self._cond:
+            self._cap = capacity
+            self._cond.notify_all()
+    
+    async def _admit(self) -> None:
+        """Wait up to the admission timeout for a free session slot and claim it"""
+        async with self._cond:
+            try:
+                await asyncio.wait_for(
+                    self._cond.wait_for(lambda: self._active < self._cap),
+                    self._admit_timeout
+                )
+            except asyncio.TimeoutError:
+                raise SessionCapacityError(
+                    f"No session slot freed up within {self._admit_timeout:g}s"
+                ) from None
+            self._active += 1
+    
+    async def _release_slot(self) -> None:
+        """Give a session slot back and wake the waiters"""
+        async with self._cond:
+            self._active -= 1
+            # Waking one waiter is not enough: it may be timing out right now
+            self._cond.notify_all()
     
     async def create_session(self, options: Optional[ClaudeAgentOptions] = None) -> str:
         """Create a new session and return session ID"""
-        session_id = str(uuid.uuid4())
+        session_id = secrets.token_hex(16)
         
         if options is None:
             options = ClaudeAgentOptions()
         
-        client = ClaudeSDKClient(options=options)
-        await client.__aenter__()
+        await self._admit()
+        try:
+            key = _options_key(options)
+            client = self._pool.acquire(key)
+            if client is None:
+                client = ClaudeSDKClient(options=options)
+                await client.__aenter__()
+        except BaseException:
+            await self._release_slot()
+            raise
         
-        self.sessions[session_id] = client
-        self.session_options[session_id] = options
+        self._entries[session_id] = _SessionEntry(client, options, key)
         
         return session_id
     
+    def get_entry(self, session_id: str) -> Optional[_SessionEntry]:
+        """Get the bookkeeping entry for a session by ID"""
+        return self._entries.get(session_id)
+    
     def get_session(self, session_id: str) -> Optional[ClaudeSDKClient]:
         """Get a session by ID"""
-        return self.sessions.get(session_id)
+        entry = self._entries.get(session_id)
+        return entry.client if entry is not None else None
     
     async def close_session(self, session_id: str) -> bool:
-        """Close and remove a session"""
-        if session_id in self.sessions:
-            client = self.sessions[session_id]
-            await client.__aexit__(None, None, None)
-            del self.sessions[session_id]
-            if session_id in self.session_options:
-                del self.session_options[session_id]
-            return True
-        return False
-    
-    async def close_all_sessions(self):
-        """Close all active sessions"""
-        for session_id in list(self.sessions.keys()):
-            await self.close_session(session_id)
+        """Close and remove a session, keeping unused clients warm"""
+        entry = self._entries.pop(session_id, None)
+        if entry is None:
+            return False
+        try:
+            if entry.queried or not self._pool.release(entry.options_key, entry.client):
+                await entry.client.__aexit__(None, None, None)
+        finally:
+            await self._release_slot()
+        return True
+    
+    async def close_all_sessions(self) -> None:
+        """Close all active sessions and disconnect pooled clients"""
+        session_ids = list(self._entries)
+        results = await asyncio.gather(
+            *(self.close_session(session_id) for session_id in session_ids),
+            return_exceptions=True
+        )
+        for session_id, result in zip(session_ids, results, strict=True):
+            if isinstance(result, BaseException):
+                logger.warning("Failed to close session %s: %r", session_id, result)
+        await self._pool.drain()
     
     def list_sessions(self) -> List[str]:
         """List all active session IDs"""
-        return list(self.sessions.keys())
+        return list(self._entries)
+
+
+# Seconds an abandoned session response may take to wind down
+_SETTLE_TIMEOUT = 10.0
+
+
+class _SessionTurn:
+    """
+    One query's hold on a session lock.
+    The lock is released by close() only. If the response was not read up
+    to its ResultMessage, close() interrupts the client and drains what is
+    left first, so the next query does not read the old response; a session
+    that cannot be settled that way is closed instead.
+    """
+
+    def __init__(self, manager: SessionManager, session_id: str, entry: _SessionEntry) -> None:
+        self._manager = manager
+        self._session_id = session_id
+        self._entry = entry
+        self._sent = False
+        self._finished = False
+        self._closed = False
+
+    async def send(self, prompt: str) -> None:
+        """Send the prompt for this turn"""
+        await self._entry.client.query(prompt)
+        self._sent = True
+
+    async def messages(self) -> AsyncGenerator[Any, None]:
+        """Iterate this turn's response, up to and including its ResultMessage"""
+        stream = self._entry.client.receive_response()
+        try:
+            async for message in stream:
+                if isinstance(message, ResultMessage):
+                    self._finished = True
+                yield message
+        finally:
+            await _aclose(stream)
+
+    async def _drain(self) -> None:
+        client = self._entry.client
+        await client.interrupt()
+        stream = client.receive_response()
+        try:
+            async for _ in stream:
+                pass
+        finally:
+            await _aclose(stream)
+
+    async def close(self) -> None:
+        """Settle the response if it was abandoned, then release the lock"""
+        if self._closed:
+            return
+        self._closed = True
+        try:
+            if self._sent and not self._finished:
+                try:
+                    await asyncio.wait_for(self._drain(), _SETTLE_TIMEOUT)
+                except Exception as e:
+                    logger.warning(
+                        "Could not settle session %s, closing it: %r", self._session_id, e
+                    )
+                    await self._manager.close_session(self._session_id)
+        finally:
+            self._entry.lock.release()
 
 
 # ============================================
@@ -121,10 +548,10 @@ session_manager = SessionManager()
 async def lifespan(app: FastAPI):
     """Lifespan context manager for startup and shutdown"""
     # Startup
-    print(" Claude Agent SDK API Server starting up...")
+    logger.info("Claude Agent SDK API Server starting up")
     yield
     # Shutdown
-    print(" Shutting down Claude Agent SDK API Server...")
+    logger.info("Shutting down Claude Agent SDK API Server")
     await session_manager.close_all_sessions()
 
 
@@ -132,7 +559,8 @@ app = FastAPI(
     title="Claude Agent SDK API",
     description="HTTP API for Claude Agent SDK - Exposes ClaudeSDKClient functionality",
     version="1.0.0",
-    lifespan=lifespan
+    lifespan=lifespan,
+    default_response_class=_FastJSONResponse
 )
 
 
@@ -140,14 +568,17 @@ app = FastAPI(
 # Health Check Endpoint
 # ============================================
 
+# Only active_sessions changes between probes, so the rest is encoded once
+_HEALTH_PREFIX = b'{"status":"healthy","service":"claude-agent-sdk-api","active_sessions":'
+
+
 @app.get("/health", tags=["Health"])
-async def health_check():
+async def health_check() -> Response:
     """Health check endpoint"""
-    return {
-        "status": "healthy",
-        "service": "claude-agent-sdk-api",
-        "active_sessions": len(session_manager.sessions)
-    }
+    return Response(
+        _HEALTH_PREFIX + str(len(session_manager._entries)).encode() + b"}",
+        media_type="application/json"
+    )
 
 
 # ============================================
@@ -155,29 +586,33 @@ async def health_check():
 # ============================================
 
 @app.post("/query", tags=["Query"])
-async def query_claude(request: QueryRequest):
+async def query_claude(
+    request: QueryRequest, http_request: Request, buffered: bool = False
+) -> Response:
     """
     Query Claude with a prompt (stateless).
     This uses the simple query() function without maintaining session state.
     """
     try:
         # Convert options dict to ClaudeAgentOptions if provided
-        options = None
-        if request.options:
-            options = ClaudeAgentOptions(**request.options)
+        options = _build_options(request.options)
         
         if request.stream:
-            async def generate():
+            async def generate() -> AsyncIterator[bytes]:
                 try:
-                    async for message in sdk_query(request.prompt, options=options):
-                        # Format each message as JSON and yield
-                        import json
-                        yield f"data: {json.dumps({'type': 'message', 'content': str(message)})}\n\n"
-                    yield f"data: {json.dumps({'type': 'done'})}\n\n"
+                    source = sdk_query(prompt=request.prompt, options=options)
+                    async with aclosing(_read_ahead(source)) as stream:
+                        async for message in stream:
+                            # Format each message as an SSE frame and yield
+                            yield _sse_message(message)
+                            # Give other streams a turn before pulling the next message
+                            await asyncio.sleep(0)
+                    yield _SSE_DONE
                 except Exception as e:
-                    yield f"data: {json.dumps({'type': 'error', 'error': str(e)})}\n\n"
+                    logger.exception("Error while streaming query")
+                    yield _SSE_ERROR_TMPL % _dumps(str(e))
             
-            return StreamingResponse(
+            return _ClosingStreamingResponse(
                 generate(),
                 media_type="text/event-stream",
                 headers={
@@ -186,17 +621,14 @@ async def query_claude(request: QueryRequest):
                 }
             )
         else:
-            # Non-streaming response - collect all messages
-            messages = []
-            async for message in sdk_query(request.prompt, options=options):
-                messages.append(str(message))
-            
-            return JSONResponse({
-                "status": "success",
-                "messages": messages
-            })
+            # Non-streaming response - NDJSON lines unless buffering was requested
+            return await _collect_or_stream(
+                sdk_query(prompt=request.prompt, options=options),
+                buffered or _prefers_wait(http_request)
+            )
     
     except Exception as e:
+        logger.exception("Query failed")
         raise HTTPException(status_code=500, detail=str(e))
 
 
@@ -212,9 +644,7 @@ async def create_session(request: SessionCreateRequest):
     """
     try:
         # Convert options dict to ClaudeAgentOptions if provided
-        options = None
-        if request.options:
-            options = ClaudeAgentOptions(**request.options)
+        options = _build_options(request.options)
         
         session_id = await session_manager.create_session(options)
         
@@ -223,7 +653,11 @@ async def create_session(request: SessionCreateRequest):
             message="Session created successfully"
         )
     
+    except SessionCapacityError as e:
+        raise HTTPException(status_code=503, detail=str(e))
+    
     except Exception as e:
+        logger.exception("Failed to create session")
         raise HTTPException(status_code=500, detail=str(e))
 
 
@@ -232,7 +666,7 @@ async def list_sessions():
     """List all active sessions"""
     return {
         "sessions": session_manager.list_sessions(),
-        "count": len(session_manager.sessions)
+        "count": len(session_manager._entries)
     }
 
 
@@ -251,52 +685,78 @@ async def get_session_info(session_id: str):
 
 
 @app.post("/sessions/{session_id}/query", tags=["Sessions"])
-async def query_session(session_id: str, request: SessionQueryRequest):
+async def query_session(
+    session_id: str,
+    request: SessionQueryRequest,
+    http_request: Request,
+    buffered: bool = False
+) -> Response:
     """
     Query Claude within an existing session.
     This maintains conversation context across multiple queries.
     """
-    client = session_manager.get_session(session_id)
+    entry = session_manager.get_entry(session_id)
     
-    if not client:
+    if not entry:
         raise HTTPException(status_code=404, detail="Session not found")
     
+    # One query at a time per session; interleaved queries corrupt the stream
+    if entry.lock.locked():
+        raise HTTPException(status_code=409, detail="Session busy")
+    await entry.lock.acquire()
+    turn = _SessionTurn(session_manager, session_id, entry)
+    
+    entry.queried = True
+    # Set once the response owns the turn; until then every exit closes it here
+    handed_off = False
+    
     try:
         # Send query to the session
-        await client.query(request.prompt)
+        await turn.send(request.prompt)
+        messages = turn.messages()
         
         if request.stream:
-            async def generate():
+            async def generate() -> AsyncIterator[bytes]:
                 try:
-                    async for message in client.receive_response():
-                        import json
-                        yield f"data: {json.dumps({'type': 'message', 'content': str(message)})}\n\n"
-                    yield f"data: {json.dumps({'type': 'done'})}\n\n"
+                    async with aclosing(_read_ahead(messages)) as stream:
+                        async for message in stream:
+                            yield _sse_message(message)
+                            # Give other streams a turn before pulling the next message
+                            await asyncio.sleep(0)
+                    yield _SSE_DONE
                 except Exception as e:
-                    yield f"data: {json.dumps({'type': 'error', 'error': str(e)})}\n\n"
+                    logger.exception("Error while streaming session %s", session_id)
+                    yield _SSE_ERROR_TMPL % _dumps(str(e))
             
-            return StreamingResponse(
+            # The lock is held until the body is closed, even if it never starts
+            response: Response = _ClosingStreamingResponse(
                 generate(),
                 media_type="text/event-stream",
                 headers={
                     "Cache-Control": "no-cache",
                     "Connection": "keep-alive",
-                }
+                },
+                cleanup=turn.close
             )
         else:
-            # Non-streaming response
-            messages = []
-            async for message in client.receive_response():
-                messages.append(str(message))
-            
-            return JSONResponse({
-                "status": "success",
-                "session_id": session_id,
-                "messages": messages
-            })
+            # Non-streaming response - NDJSON lines unless buffering was requested
+            response = await _collect_or_stream(
+                messages,
+                buffered or _prefers_wait(http_request),
+                cleanup=turn.close,
+                session_id=session_id
+            )
+        
+        handed_off = True
+        return response
     
     except Exception as e:
+        logger.exception("Query failed for session %s", session_id)
         raise HTTPException(status_code=500, detail=str(e))
+    
+    finally:
+        if not handed_off:
+            await turn.close()
 
 
 @app.delete("/sessions/{session_id}", tags=["Sessions"])
@@ -313,17 +773,56 @@ async def delete_session(session_id: str):
     }
 
 
+# ============================================
+# Admin Endpoints
+# ============================================
+
+@app.patch("/admin/capacity", tags=["Admin"])
+async def update_capacity(request: CapacityUpdateRequest) -> Dict[str, Any]:
+    """
+    Resize the maximum number of concurrent sessions.
+    Applies only to the worker process that handles the request.
+    """
+    await session_manager.set_capacity(request.max_sessions)
+    
+    return {
+        "max_sessions": session_manager.capacity,
+        "active_sessions": len(session_manager._entries),
+        "scope": "worker",
+        "pid": os.getpid()
+    }
+
+
 # ============================================
 # Main Entry Point
 # ============================================
 
-def start_server(host: str = "0.0.0.0", port: int = 8000, reload: bool = False):
-    """Start the API server"""
+def start_server(
+    host: str = "0.0.0.0",
+    port: int = 8000,
+    reload: bool = False,
+    workers: int = 1
+):
+    """
+    Start the API server.
+    Sessions live in the worker process that created them, so with more
+    than one worker the load balancer must route by session_id. The
+    session cap, client pool and /admin/capacity are per worker too, so
+    N workers allow up to N times CLAUDE_MAX_SESSIONS sessions.
+    A workers value of 0 starts one worker per CPU core.
+    """
+    # Deferred so importing the app module alone does not pull in uvicorn
+    import uvicorn
+    
+    if workers <= 0:
+        workers = os.cpu_count() or 1
+    
     uvicorn.run(
         "claude_agent_sdk.api_server:app",
         host=host,
         port=port,
         reload=reload,
+        workers=workers,
         log_level="info"
     )
 
@@ -335,7 +834,13 @@ if __name__ == "__main__":
     parser.add_argument("--host", default="0.0.0.0", help="Host to bind to")
     parser.add_argument("--port", type=int, default=8000, help="Port to bind to")
     parser.add_argument("--reload", action="store_true", help="Enable auto-reload")
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="Number of worker processes (0 for one per CPU core)"
+    )
     
     args = parser.parse_args()
     
-    start_server(host=args.host, port=args.port, reload=args.reload)
+    start_server(host=args.host, port=args.port, reload=args.reload, workers=args.workers)
@@ -2,26 +2,60 @@
 Tests for the Claude Agent SDK API Server
 """
 
+import asyncio
+import json
+from unittest.mock import AsyncMock
+
+import anyio
 import pytest
-from httpx import AsyncClient
-from claude_agent_sdk.api_server import app
+from httpx import ASGITransport, AsyncClient
+from claude_agent_sdk import (
+    AssistantMessage,
+    ClaudeAgentOptions,
+    ResultMessage,
+    TextBlock,
+    ThinkingBlock,
+    UserMessage,
+)
+from claude_agent_sdk.api_server import (
+    _SSE_DONE,
+    _SSE_ERROR_TMPL,
+    SessionCapacityError,
+    SessionManager,
+    SessionQueryRequest,
+    _build_options,
+    _collect_or_stream,
+    _dumps,
+    _options_key,
+    _read_ahead,
+    _SessionEntry,
+    _sse_message,
+    app,
+    query_session,
+    session_manager,
+)
 
 
 @pytest.mark.asyncio
 async def test_health_check():
     """Test the health check endpoint"""
-    async with AsyncClient(app=app, base_url="http://test") as client:
+    transport = ASGITransport(app=app)
+    async with AsyncClient(transport=transport, base_url="http://test") as client:
         response = await client.get("/health")
         assert response.status_code == 200
-        data = response.json()
-        assert data["status"] == "healthy"
-        assert "active_sessions" in data
+        assert response.headers["content-type"] == "application/json"
+        assert response.content == (
+            b'{"status":"healthy","service":"claude-agent-sdk-api","active_sessions":'
+            + str(len(session_manager.list_sessions())).encode()
+            + b"}"
+        )
 
 
 @pytest.mark.asyncio
 async def test_create_session():
     """Test session creation"""
-    async with AsyncClient(app=app, base_url="http://test") as client:
+    transport = ASGITransport(app=app)
+    async with AsyncClient(transport=transport, base_url="http://test") as client:
         response = await client.post("/sessions", json={})
         assert response.status_code == 200
         data = response.json()
@@ -32,7 +66,8 @@ async def test_create_session():
 @pytest.mark.asyncio
 async def test_list_sessions():
     """Test listing sessions"""
-    async with AsyncClient(app=app, base_url="http://test") as client:
+    transport = ASGITransport(app=app)
+    async with AsyncClient(transport=transport, base_url="http://test") as client:
         # Create a session first
         create_response = await client.post("/sessions", json={})
         assert create_response.status_code == 200
@@ -48,7 +83,8 @@ async def test_list_sessions():
 @pytest.mark.asyncio
 async def test_delete_session():
     """Test session deletion"""
-    async with AsyncClient(app=app, base_url="http://test") as client:
+    transport = ASGITransport(app=app)
+    async with AsyncClient(transport=transport, base_url="http://test") as client:
         # Create a session
         create_response = await client.post("/sessions", json={})
         session_id = create_response.json()["session_id"]
@@ -62,9 +98,467 @@ async def test_delete_session():
 @pytest.mark.asyncio
 async def test_query_nonexistent_session():
     """Test querying a non-existent session"""
-    async with AsyncClient(app=app, base_url="http://test") as client:
+    transport = ASGITransport(app=app)
+    async with AsyncClient(transport=transport, base_url="http://test") as client:
         response = await client.post(
             "/sessions/nonexistent-id/query",
             json={"prompt": "Hello", "stream": False}
         )
         assert response.status_code == 404
+
+
+@pytest.mark.asyncio
+async def test_update_capacity():
+    """Test resizing the session cap through the admin endpoint"""
+    capacity = session_manager.capacity
+    try:
+        transport = ASGITransport(app=app)
+        async with AsyncClient(transport=transport, base_url="http://test") as client:
+            response = await client.patch("/admin/capacity", json={"max_sessions": 3})
+            assert response.status_code == 200
+            data = response.json()
+            assert data["max_sessions"] == 3
+            assert data["scope"] == "worker"
+            assert data["active_sessions"] == len(session_manager.list_sessions())
+            assert session_manager.capacity == 3
+
+            response = await client.patch("/admin/capacity", json={"max_sessions": 0})
+            assert response.status_code == 422
+            assert session_manager.capacity == 3
+    finally:
+        await session_manager.set_capacity(capacity)
+
+
+def test_sse_frame_encoding():
+    """Test SSE frames are compact JSON bytes with escaped content"""
+    frame = _sse_message('say "hi"\n')
+    assert isinstance(frame, bytes)
+    assert frame == b'data: {"type":"message","message":"say \\"hi\\"\\n"}\n\n'
+
+
+def test_sse_terminal_frames():
+    """Test the precomputed done and error frames"""
+    assert _SSE_DONE == b'data: {"type":"done"}\n\n'
+    assert _SSE_ERROR_TMPL % _dumps('bad "input"') == (
+        b'data: {"type":"error","error":"bad \\"input\\""}\n\n'
+    )
+
+
+def test_sse_message_frames():
+    """Test message frames for text chunks, byte chunks and dataclasses"""
+    assert _sse_message("hi") == b'data: {"type":"message","message":"hi"}\n\n'
+    assert _sse_message(b"hi") == b'data: {"type":"message","message":"hi"}\n\n'
+    message = AssistantMessage(content=[TextBlock(text="Hello")], model="sonnet")
+    assert _sse_message(message) == (
+        b'data: {"type":"message","message":{"type":"AssistantMessage",'
+        b'"content":[{"type":"TextBlock","text":"Hello"}],'
+        b'"model":"sonnet","parent_tool_use_id":null}}\n\n'
+    )
+
+
+def test_dumps_serializes_sdk_messages():
+    """Test SDK message dataclasses serialize with their structured fields"""
+    message = AssistantMessage(content=[TextBlock(text="Hello")], model="sonnet")
+    assert json.loads(_dumps({"type": "message", "message": message})) == {
+        "type": "message",
+        "message": {
+            "type": "AssistantMessage",
+            "content": [{"type": "TextBlock", "text": "Hello"}],
+            "model": "sonnet",
+            "parent_tool_use_id": None,
+        },
+    }
+
+
+def test_dumps_tags_messages_with_their_type():
+    """Test messages with identical fields stay distinguishable by type"""
+    user = json.loads(_dumps(UserMessage(content=[TextBlock(text="hi")])))
+    thinking = json.loads(_dumps(ThinkingBlock(thinking="hmm", signature="sig")))
+    assert user["type"] == "UserMessage"
+    assert user["content"][0]["type"] == "TextBlock"
+    assert thinking["type"] == "ThinkingBlock"
+
+
+def test_build_options_reuses_equal_profiles():
+    """Test equal option dicts share one ClaudeAgentOptions instance"""
+    assert _build_options(None) is None
+    first = _build_options({"model": "sonnet", "env": {"A": "1", "B": "2"}})
+    second = _build_options({"env": {"B": "2", "A": "1"}, "model": "sonnet"})
+    assert isinstance(first, ClaudeAgentOptions)
+    assert first is second
+    assert first.env == {"A": "1", "B": "2"}
+
+
+@pytest.mark.asyncio
+async def test_read_ahead_preserves_order_and_errors():
+    """Test read-ahead yields every message in order, then re-raises failures"""
+
+    async def messages():
+        for i in range(40):
+            yield i
+        raise RuntimeError("upstream failed")
+
+    received = []
+    with pytest.raises(RuntimeError, match="upstream failed"):
+        async for message in _read_ahead(messages(), maxsize=4):
+            received.append(message)
+    assert received == list(range(40))
+
+
+@pytest.mark.asyncio
+async def test_read_ahead_early_exit_closes_task_group_source():
+    """Test stopping early closes an anyio-backed source in its own task"""
+    closed = []
+
+    async def messages():
+        async with anyio.create_task_group() as tg:
+            tg.start_soon(anyio.sleep_forever)
+            try:
+                for i in range(100):
+                    yield i
+            finally:
+                tg.cancel_scope.cancel()
+                closed.append(True)
+
+    received = []
+    stream = _read_ahead(messages(), maxsize=4)
+    async for message in stream:
+        received.append(message)
+        if message == 2:
+            break
+    await stream.aclose()
+    assert received == [0, 1, 2]
+    assert closed == [True]
+
+
+@pytest.mark.asyncio
+async def test_session_manager_close_session():
+    """Test closing a session tears down its client and drops the entry"""
+    manager = SessionManager()
+    client = AsyncMock()
+    manager._entries["abc"] = _SessionEntry(client, ClaudeAgentOptions(), "key")
+    manager._entries["abc"].queried = True
+
+    assert manager.get_session("abc") is client
+    assert await manager.close_session("abc") is True
+    client.__aexit__.assert_awaited_once_with(None, None, None)
+    assert manager.list_sessions() == []
+    assert await manager.close_session("abc") is False
+
+
+@pytest.mark.asyncio
+async def test_session_manager_reuses_unqueried_client():
+    """Test a never-queried client is pooled and handed to the next session"""
+    manager = SessionManager()
+    options = ClaudeAgentOptions(model="sonnet")
+    client = AsyncMock()
+    manager._entries["abc"] = _SessionEntry(client, options, _options_key(options))
+
+    assert await manager.close_session("abc") is True
+    client.__aexit__.assert_not_awaited()
+
+    session_id = await manager.create_session(ClaudeAgentOptions(model="sonnet"))
+    assert manager.get_session(session_id) is client
+
+    await manager.close_all_sessions()
+    client.__aexit__.assert_awaited_once_with(None, None, None)
+
+
+@pytest.mark.asyncio
+async def test_close_all_sessions_logs_failed_teardowns(caplog):
+    """Test a failing teardown is logged and does not stop the others"""
+    manager = SessionManager()
+    broken = AsyncMock()
+    broken.__aexit__.side_effect = RuntimeError("teardown failed")
+    healthy = AsyncMock()
+    for session_id, client in (("broken", broken), ("healthy", healthy)):
+        manager._entries[session_id] = _SessionEntry(client, ClaudeAgentOptions(), "key")
+        manager._entries[session_id].queried = True
+
+    await manager.close_all_sessions()
+
+    healthy.__aexit__.assert_awaited_once()
+    assert manager.list_sessions() == []
+    assert "Failed to close session broken" in caplog.text
+
+
+@pytest.mark.asyncio
+async def test_session_manager_admission_waits_for_capacity():
+    """Test create_session blocks at the cap until a slot is released"""
+    manager = SessionManager()
+    await manager.set_capacity(1)
+    for _ in range(2):
+        manager._pool.release(_options_key(ClaudeAgentOptions()), AsyncMock())
+
+    first = await manager.create_session()
+    second = asyncio.create_task(manager.create_session())
+    await asyncio.sleep(0)
+    assert not second.done()
+
+    await manager.set_capacity(2)
+    await asyncio.wait_for(second, timeout=1)
+    assert len(manager.list_sessions()) == 2
+    assert first in manager.list_sessions()
+
+
+@pytest.mark.asyncio
+async def test_session_admission_times_out_with_503():
+    """Test a create_session that cannot get a slot gives up without leaking one"""
+    manager = SessionManager()
+    manager._admit_timeout = 0.01
+    await manager.set_capacity(0)
+    with pytest.raises(SessionCapacityError):
+        await manager.create_session()
+    assert manager._active == 0
+
+    capacity = session_manager.capacity
+    admit_timeout = session_manager._admit_timeout
+    session_manager._admit_timeout = 0.01
+    await session_manager.set_capacity(0)
+    try:
+        transport = ASGITransport(app=app)
+        async with AsyncClient(transport=transport, base_url="http://test") as client:
+            response = await client.post("/sessions", json={})
+        assert response.status_code == 503
+    finally:
+        session_manager._admit_timeout = admit_timeout
+        await session_manager.set_capacity(capacity)
+
+
+@pytest.mark.asyncio
+async def test_collect_or_stream_modes():
+    """Test non-SSE responses stream NDJSON by default and buffer on request"""
+
+    async def messages():
+        yield {"text": "one"}
+        yield {"text": "two"}
+
+    response = await _collect_or_stream(messages(), force_buffer=False)
+    assert response.media_type == "application/x-ndjson"
+    body = b"".join([chunk async for chunk in response.body_iterator])
+    assert [json.loads(line) for line in body.splitlines()] == [
+        {"type": "message", "message": {"text": "one"}},
+        {"type": "message", "message": {"text": "two"}},
+        {"type": "done"},
+    ]
+
+    response = await _collect_or_stream(messages(), force_buffer=True, session_id="abc")
+    assert json.loads(response.body) == {
+        "status": "success",
+        "session_id": "abc",
+        "messages": [{"text": "one"}, {"text": "two"}],
+    }
+
+
+@pytest.mark.asyncio
+async def test_query_session_rejects_concurrent_queries():
+    """Test a busy session returns 409 and its lock is freed after a query"""
+    client = AsyncMock()
+
+    async def receive_response():
+        yield {"text": "done"}
+
+    client.receive_response = receive_response
+    entry = _SessionEntry(client, ClaudeAgentOptions(), "key")
+    session_manager._entries["busy"] = entry
+    transport = ASGITransport(app=app)
+    try:
+        async with AsyncClient(transport=transport, base_url="http://test") as http:
+            await entry.lock.acquire()
+            response = await http.post("/sessions/busy/query", json={"prompt": "Hi"})
+            assert response.status_code == 409
+            entry.lock.release()
+
+            response = await http.post(
+                "/sessions/busy/query?buffered=1",
+                json={"prompt": "Hi", "stream": False},
+            )
+            assert response.status_code == 200
+            assert response.json()["messages"] == [{"text": "done"}]
+            assert not entry.lock.locked()
+    finally:
+        del session_manager._entries["busy"]
+
+
+@pytest.mark.asyncio
+async def test_query_session_releases_lock_when_cancelled():
+    """Test cancellation before the response is built frees the session lock"""
+    client = AsyncMock()
+    client.query.side_effect = asyncio.CancelledError
+    entry = _SessionEntry(client, ClaudeAgentOptions(), "key")
+    session_manager._entries["cancelled"] = entry
+    try:
+        with pytest.raises(asyncio.CancelledError):
+            await query_session(
+                "cancelled", SessionQueryRequest(prompt="Hi"), AsyncMock()
+            )
+        assert not entry.lock.locked()
+    finally:
+        del session_manager._entries["cancelled"]
+
+
+@pytest.mark.asyncio
+async def test_query_endpoint_formats(monkeypatch):
+    """Test /query passes the prompt through and renders each response format"""
+    calls = []
+
+    async def fake_query(*, prompt, options=None):
+        calls.append((prompt, options))
+        yield AssistantMessage(content=[TextBlock(text="4")], model="sonnet")
+
+    monkeypatch.setattr("claude_agent_sdk.api_server.sdk_query", fake_query)
+    transport = ASGITransport(app=app)
+    async with AsyncClient(transport=transport, base_url="http://test") as client:
+        body = {"prompt": "2 + 2?", "options": {"model": "sonnet"}}
+        sse = await client.post("/query", json=body)
+        ndjson = await client.post("/query", json={**body, "stream": False})
+        buffered = await client.post(
+            "/query?buffered=1", json={**body, "stream": False}
+        )
+
+    message = {
+        "type": "AssistantMessage",
+        "content": [{"type": "TextBlock", "text": "4"}],
+        "model": "sonnet",
+        "parent_tool_use_id": None,
+    }
+    assert [prompt for prompt, _ in calls] == ["2 + 2?"] * 3
+    assert calls[0][1].model == "sonnet"
+    assert sse.headers["content-type"].startswith("text/event-stream")
+    assert sse.text.split("\n\n")[:2] == [
+        "data: " + json.dumps({"type": "message", "message": message}, separators=(",", ":")),
+        'data: {"type":"done"}',
+    ]
+    assert [json.loads(line) for line in ndjson.text.splitlines()] == [
+        {"type": "message", "message": message},
+        {"type": "done"},
+    ]
+    assert buffered.json() == {"status": "success", "messages": [message]}
+
+
+async def _post_then_disconnect(path, payload, frames):
+    """Drive the ASGI app directly, disconnecting after `frames` body chunks"""
+    body_chunks = []
+    disconnected = asyncio.Event()
+    if frames == 0:
+        disconnected.set()
+    request_sent = False
+
+    async def receive():
+        nonlocal request_sent
+        if not request_sent:
+            request_sent = True
+            return {"type": "http.request", "body": json.dumps(payload).encode()}
+        await disconnected.wait()
+        return {"type": "http.disconnect"}
+
+    async def send(message):
+        if message["type"] == "http.response.body" and message.get("body"):
+            body_chunks.append(message["body"])
+            if len(body_chunks) >= frames:
+                disconnected.set()
+
+    scope = {
+        "type": "http",
+        # uvicorn's h11 and httptools protocols report ASGI spec 2.3
+        "asgi": {"version": "3.0", "spec_version": "2.3"},
+        "http_version": "1.1",
+        "method": "POST",
+        "scheme": "http",
+        "path": path,
+        "raw_path": path.encode(),
+        "query_string": b"",
+        "root_path": "",
+        "headers": [(b"content-type", b"application/json")],
+        "client": ("test", 1234),
+        "server": ("test", 80),
+    }
+    await app(scope, receive, send)
+    return body_chunks
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("stream", [True, False])
+async def test_query_stream_disconnect_closes_source(monkeypatch, stream):
+    """Test a client disconnect closes the SDK iterator before the handler returns"""
+    pulled = 0
+    closed = []
+
+    async def endless_query(*, prompt, options=None):
+        nonlocal pulled
+        try:
+            while True:
+                pulled += 1
+                yield {"n": pulled}
+                await asyncio.sleep(0)
+        finally:
+            closed.append(True)
+
+    monkeypatch.setattr("claude_agent_sdk.api_server.sdk_query", endless_query)
+    chunks = await _post_then_disconnect(
+        "/query", {"prompt": "Hi", "stream": stream}, frames=2
+    )
+
+    assert len(chunks) >= 2
+    assert closed == [True]
+    pulled_at_return = pulled
+    await asyncio.sleep(0.05)
+    assert pulled == pulled_at_return
+
+
+class _InterruptibleClient:
+    """Session client whose response only ends once it is interrupted"""
+
+    def __init__(self, lock):
+        self.lock = lock
+        self.events = []
+        self.interrupted = False
+        self.lock_held_at_interrupt = None
+
+    async def query(self, prompt):
+        self.events.append("query")
+
+    async def interrupt(self):
+        self.events.append("interrupt")
+        self.lock_held_at_interrupt = self.lock.locked()
+        self.interrupted = True
+
+    async def receive_response(self):
+        try:
+            n = 0
+            while not self.interrupted:
+                n += 1
+                yield {"n": n}
+                await asyncio.sleep(0)
+            yield ResultMessage(
+                subtype="interrupted", duration_ms=1, duration_api_ms=1,
+                is_error=False, num_turns=1, session_id="default"
+            )
+        finally:
+            self.events.append(("closed", self.lock.locked()))
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("frames", [0, 2])
+@pytest.mark.parametrize("stream", [True, False])
+async def test_query_session_disconnect_settles_before_release(stream, frames):
+    """Test a disconnected session query is interrupted and drained before unlocking"""
+    entry = _SessionEntry(None, ClaudeAgentOptions(), "key")
+    client = _InterruptibleClient(entry.lock)
+    entry.client = client
+    session_manager._entries["gone"] = entry
+    try:
+        await _post_then_disconnect(
+            "/sessions/gone/query", {"prompt": "Hi", "stream": stream}, frames=frames
+        )
+
+        assert client.events[0] == "query"
+        assert client.lock_held_at_interrupt is True
+        # Every response iterator was closed while the lock was still held
+        closes = [event for event in client.events if isinstance(event, tuple)]
+        assert closes and all(held for _, held in closes)
+        assert client.events[-1] == ("closed", True)
+        assert not entry.lock.locked()
+        assert session_manager.get_entry("gone") is entry
+    finally:
+        session_manager._entries.pop("gone", None)